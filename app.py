@@ -1,12 +1,19 @@
 import streamlit as st
 import google.generativeai as genai
-from PIL import Image
+from PIL import Image, ImageOps
 from gtts import gTTS
 import io
+import hashlib
 import os
-import tempfile
-from pathlib import Path
+import re
+import threading
+import time
+from dataclasses import dataclass
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from cachetools import LRUCache
 from elevenlabs.client import ElevenLabs  # Import the Client class
+# Import the error type raised for non-2xx API responses (e.g. a rejected key)
+from elevenlabs.core.api_error import ApiError
 # Import the specific response object type for voices
 from elevenlabs.types.get_voices_response import GetVoicesResponse
 # Import the specific object type for voice settings
@@ -16,14 +23,46 @@ from elevenlabs.types.voice_settings import VoiceSettings
 # --- Configuration ---
 st.set_page_config(layout="wide", page_title="AI Image to Story & Human-like Speech")
 
+# Voice ID of ElevenLabs' premade "Rachel" voice, used when the voice list can't be fetched
+DEFAULT_VOICE_ID = "21m00Tcm4TlvDq8ikWAM"
+
+# ElevenLabs requests in flight at once across every session of this process. Free and starter
+# plans only allow a couple of concurrent requests; raise ELEVENLABS_MAX_CONCURRENCY in secrets
+# on larger plans.
+try:
+    ELEVENLABS_MAX_CONCURRENCY = max(1, int(st.secrets.get("ELEVENLABS_MAX_CONCURRENCY", 2)))
+except Exception:
+    ELEVENLABS_MAX_CONCURRENCY = 2 # No secrets file or an invalid value; keep the safe default
+# Times a chunk is retried, with exponential backoff, when ElevenLabs answers 429
+ELEVENLABS_RATE_LIMIT_RETRIES = 3
+
+# --- Cached Clients ---
+# Streamlit re-executes this script on every interaction; build the SDK clients once per process
+@st.cache_resource(show_spinner=False)
+def _init_gemini(api_key):
+    """Configures Gemini and returns the vision model."""
+    genai.configure(api_key=api_key)
+    # Initialize the Gemini 1.5 Flash model (recommended for vision tasks now); it handles
+    # text-only prompts too, so no separate text model is kept
+    return genai.GenerativeModel('gemini-1.5-flash-latest')
+
+@st.cache_resource(show_spinner=False)
+def _init_elevenlabs(api_key):
+    """Returns an ElevenLabs client for the given API key."""
+    # The SDK keeps a pooled keep-alive httpx client. Idle connections only live a few seconds,
+    # so the reuse this buys is between the chunks of one story, not across runs.
+    return ElevenLabs(api_key=api_key)
+
+@st.cache_resource(show_spinner=False)
+def _elevenlabs_request_slots():
+    """Returns the process-wide semaphore that caps concurrent ElevenLabs requests."""
+    return threading.BoundedSemaphore(ELEVENLABS_MAX_CONCURRENCY)
+
 # --- API Keys Configuration ---
 try:
     # Configure the Gemini API key from Streamlit secrets
     gemini_api_key = st.secrets["GEMINI_API_KEY"]
-    genai.configure(api_key=gemini_api_key)
-    # Initialize the Gemini 1.5 Flash model (recommended for vision tasks now)
-    vision_model = genai.GenerativeModel('gemini-1.5-flash-latest')
-    text_model = genai.GenerativeModel('gemini-1.5-flash-latest') # Keep text model just in case, though vision handles both
+    vision_model = _init_gemini(gemini_api_key)
     gemini_api_configured = True
 except KeyError:
     st.error("🚨 Gemini API Key not found. Please add it to your Streamlit secrets (.streamlit/secrets.toml).")
@@ -37,17 +76,15 @@ elevenlabs_client = None # Initialize client to None
 elevenlabs_configured = False
 try:
     elevenlabs_api_key = st.secrets.get("ELEVENLABS_API_KEY", "")
-    if elevenlabs_api_key:
+    if elevenlabs_api_key and not st.session_state.get("elevenlabs_key_rejected"):
         try:
             # Create an instance of the ElevenLabs client
-            elevenlabs_client = ElevenLabs(api_key=elevenlabs_api_key)
-            # Test by fetching voices (using the instance)
-            # This call might raise an exception if the key is invalid or network error
-            # We don't need the result here, just testing the connection/auth
-            test_voices_fetch = elevenlabs_client.voices.get_all()
+            # The key is not probed here, which would cost a network round trip before anything
+            # renders; the first real request reports a rejected key (see handle_elevenlabs_error)
+            elevenlabs_client = _init_elevenlabs(elevenlabs_api_key)
             elevenlabs_configured = True
         except Exception as e:
-             st.error(f"🚨 ElevenLabs client initialization or test voice fetch failed: {e}")
+             st.error(f"🚨 ElevenLabs client initialization failed: {e}")
              elevenlabs_configured = False
     else:
         elevenlabs_configured = False
@@ -57,113 +94,385 @@ except Exception as e:
 
 
 # --- Helper Functions ---
-def generate_story_from_image(image_data, prompt):
-    """Generates a story from an image and a prompt using Gemini."""
+def content_digest(data):
+    """Returns the SHA256 hex digest of bytes or text, used as a compact cache key."""
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+def handle_elevenlabs_error(error, context):
+    """Reports an ElevenLabs failure; returns True if ElevenLabs refused the account's requests."""
+    if isinstance(error, ApiError) and error.status_code == 401:
+        # 401 covers an invalid key as well as an exhausted quota or a blocked account, so show
+        # the reason ElevenLabs gave, e.g. {"detail": {"status": "quota_exceeded", "message": ...}}
+        detail = error.body.get("detail") if isinstance(error.body, dict) else error.body
+        if isinstance(detail, dict):
+            detail = detail.get("message") or detail.get("status")
+        reason = f": {detail}" if detail else ""
+        # Stop using ElevenLabs for the rest of this session
+        st.session_state["elevenlabs_key_rejected"] = True
+        st.warning(f"ElevenLabs refused the request (401{reason}). Falling back to Google TTS (standard voice) for this session.")
+        return True
+    st.error(f"{context}: {error}")
+    return False
+
+@dataclass(slots=True)
+class StoryResult:
+    """Outcome of generate_story_from_image: the story when ok, otherwise a message for the user."""
+    ok: bool
+    text: str = ""
+    err: str = ""
+
+# Sentence boundaries used to pipeline speech synthesis
+SENTENCE_BOUNDARY_RE = re.compile(r"(?<=[.!?])\s+")
+
+def split_sentences(text):
+    """Splits text after '.', '!' or '?', dropping empty pieces."""
+    return [s.strip() for s in SENTENCE_BOUNDARY_RE.split(text) if s.strip()]
+
+# Longest side, in pixels, of the image sent to Gemini; the vision model downsamples anyway
+GEMINI_MAX_IMAGE_SIDE = 1024
+
+# Cached per image digest for an hour so re-uploads of the same file skip re-encoding
+@st.cache_data(max_entries=32, ttl=3600, show_spinner=False)
+def _compress_image_cached(image_digest, _img_bytes):
+    # Apply the EXIF orientation first; the JPEG re-encode drops EXIF, so phone photos would
+    # otherwise reach Gemini rotated
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(_img_bytes)))
+    image.thumbnail((GEMINI_MAX_IMAGE_SIDE, GEMINI_MAX_IMAGE_SIDE), Image.Resampling.LANCZOS)
+    if image.mode in ("RGBA", "LA", "P"):
+        # Flatten transparency onto white; a plain convert("RGB") would turn it black
+        image = image.convert("RGBA")
+        image = Image.alpha_composite(Image.new("RGBA", image.size, "white"), image)
+    with io.BytesIO() as output:
+        image.convert("RGB").save(output, format="JPEG", quality=85, optimize=True)
+        return output.getvalue()
+
+# Finished stories keyed by (image digest, prompt). A plain LRU is used instead of
+# st.cache_data because stories are streamed and only stored once complete. This and every
+# st.cache_data cache in this file is shared by all sessions, so each one is size-bounded.
+@st.cache_resource(show_spinner=False)
+def _story_cache():
+    """Returns the process-wide story LRU and the lock guarding it."""
+    return LRUCache(maxsize=128), threading.Lock()
+
+def iter_story_chunks(jpeg_bytes, prompt):
+    """Yields story text from Gemini chunk by chunk as it is generated."""
+    image_parts = [
+        {
+            "mime_type": "image/jpeg",
+            "data": jpeg_bytes
+        }
+    ]
+    # Keep the image first so every prompt for the same upload shares an identical request
+    # prefix. Explicit CachedContent isn't used: it needs a pinned model version and a
+    # minimum context far larger than a single image's tokens.
+    prompt_parts = [
+        image_parts[0],
+        f"\n\n{prompt}",
+    ]
+    response = vision_model.generate_content(prompt_parts, stream=True)
+
+    for chunk in response:
+        # Check if the chunk has candidates and parts
+        if chunk.candidates and chunk.candidates[0].content.parts:
+            yield chunk.candidates[0].content.parts[0].text
+
+def generate_story_from_image(img_bytes, prompt, on_text=None, on_sentence=None):
+    """Generates a story from raw image bytes and a prompt using Gemini."""
+    # on_text receives the story so far after every streamed chunk and on_sentence each
+    # completed sentence, so callers can render and narrate while Gemini is still writing
     if not gemini_api_configured:
-        return "Story generation unavailable due to API configuration issues."
-    try:
-        # Ensure image_data is bytes
-        if hasattr(image_data, 'getvalue'):
-            img_bytes = image_data.getvalue()
-        elif isinstance(image_data, bytes):
-            img_bytes = image_data
-        else:
-            # Fallback for PIL Image objects if not passed as BytesIO
-            with io.BytesIO() as output:
-                image_data.save(output, format="PNG")
-                img_bytes = output.getvalue()
-
-        image_parts = [
-            {
-                "mime_type": "image/png",
-                "data": img_bytes
-            }
-        ]
-        prompt_parts = [
-            image_parts[0],
-            f"\n\n{prompt}",
-        ]
-        response = vision_model.generate_content(prompt_parts)
-
-        # Check if the response has candidates and parts
-        if response.candidates and response.candidates[0].content.parts:
-            return response.candidates[0].content.parts[0].text
-        else:
-            # Log the full response for debugging if it's not as expected
-            st.warning(f"Unexpected response structure from Gemini: {response}")
-            return "Could not generate a story from the image. The response was empty or malformed."
+        return StoryResult(ok=False, err="Story generation unavailable due to API configuration issues.")
 
-    except Exception as e:
-        # Log the specific error
-        st.error(f"Gemini API Error: {e}")
-        return f"An error occurred during story generation: {e}"
+    image_digest = content_digest(img_bytes)
+    story_cache, story_cache_lock = _story_cache()
+    with story_cache_lock:
+        cached_story = story_cache.get((image_digest, prompt))
+
+    if cached_story is not None:
+        chunks = iter([cached_story])
+    else:
+        try:
+            # Shrink and re-encode before upload; a phone photo can be 10+ MB
+            jpeg_bytes = _compress_image_cached(image_digest, img_bytes)
+        except Exception as e:
+            return StoryResult(ok=False, err=f"Could not read the uploaded image: {e}")
+        chunks = iter_story_chunks(jpeg_bytes, prompt)
+
+    story = ""
+    unfinished = "" # Text after the last sentence boundary seen so far
+    while True:
+        # Only the Gemini call is guarded here; errors raised by the callbacks propagate
+        try:
+            chunk = next(chunks, None)
+        except Exception as e:
+            return StoryResult(ok=False, err=f"An error occurred during story generation (Gemini API error): {e}")
+        if chunk is None:
+            break
+        story += chunk
+        if on_text:
+            on_text(story)
+        *sentences, unfinished = SENTENCE_BOUNDARY_RE.split(unfinished + chunk)
+        if on_sentence:
+            for sentence in sentences:
+                if sentence.strip():
+                    on_sentence(sentence.strip())
+
+    if not story:
+        return StoryResult(ok=False, err="Could not generate a story from the image. Gemini returned no story text (the response was empty or blocked).")
+    if on_sentence and unfinished.strip():
+        on_sentence(unfinished.strip())
+
+    with story_cache_lock:
+        story_cache[(image_digest, prompt)] = story
+    return StoryResult(ok=True, text=story)
+
+def stream_speech_elevenlabs(text, voice_id=DEFAULT_VOICE_ID, voice_settings=None, low_latency=False, previous_text="", next_text=""):
+    """Yields MP3 chunks from the ElevenLabs streaming endpoint as soon as they arrive."""
+    # --- Prepare parameters for client.text_to_speech.stream ---
+    stream_params = {
+        "text": text,
+        "voice_id": voice_id, # The streaming endpoint needs the voice_id, not the display name
+        "model_id": "eleven_multilingual_v2", # Using a common model name
+        "optimize_streaming_latency": 3, # Trade a little quality for a faster first chunk
+        "output_format": "mp3_44100_64",
+    }
+
+    # The surrounding text keeps intonation continuous across separately synthesized chunks
+    if previous_text:
+        stream_params["previous_text"] = previous_text
+    if next_text:
+        stream_params["next_text"] = next_text
+
+    if low_latency:
+        # Turbo model, most aggressive latency optimization and a smaller MP3 for the fastest first byte
+        stream_params["model_id"] = "eleven_turbo_v2_5"
+        stream_params["optimize_streaming_latency"] = 4
+        stream_params["output_format"] = "mp3_22050_32"
+
+    if voice_settings:
+         # Create a VoiceSettings object from the slider values
+         # Note: ElevenLabs API parameter is typically 'similarity_boost', not 'clarity'
+         stream_params["voice_settings"] = VoiceSettings(
+             stability=voice_settings.get("stability", 0.5),
+             similarity_boost=voice_settings.get("clarity", 0.75) # Map 'clarity' slider value to 'similarity_boost'
+         )
+
+    yield from elevenlabs_client.text_to_speech.stream(**stream_params)
+
+# Cached per (chunk digest, voice, settings, mode); the digest covers the chunk together with
+# its previous/next context, and settings_key is a sorted tuple of the slider values. Kept for a day.
+@st.cache_data(max_entries=512, ttl=24 * 3600, show_spinner=False)
+def _synthesize_chunk_cached(chunk_digest, voice_id, settings_key, low_latency, _chunk, _previous_text, _next_text):
+    voice_settings = dict(settings_key) if settings_key else None
+    for attempt in range(ELEVENLABS_RATE_LIMIT_RETRIES + 1):
+        try:
+            # Write each chunk into the buffer as it streams in instead of collecting a list first
+            audio_buffer = io.BytesIO()
+            for chunk in stream_speech_elevenlabs(
+                _chunk,
+                voice_id=voice_id,
+                voice_settings=voice_settings,
+                low_latency=low_latency,
+                previous_text=_previous_text,
+                next_text=_next_text,
+            ):
+                audio_buffer.write(chunk)
+            return audio_buffer.getvalue()
+        except ApiError as e:
+            # 429 means the plan's concurrency limit was hit; back off and retry this chunk
+            if e.status_code != 429 or attempt == ELEVENLABS_RATE_LIMIT_RETRIES:
+                raise
+            time.sleep(2 ** attempt)
+
+class SpeechPipeline:
+    """Synthesizes a story with ElevenLabs in the background as its sentences arrive."""
+
+    # Sentences are batched into chunks of about this many characters. The first sentence is
+    # sent on its own so the opening line is ready as early as possible.
+    CHUNK_CHARS = 250
+    # Bits per second of the constant-bitrate MP3 each mode requests from stream_speech_elevenlabs
+    BITRATE = 64_000
+    LOW_LATENCY_BITRATE = 32_000
+
+    def __init__(self, voice_id=DEFAULT_VOICE_ID, voice_settings=None, low_latency=False):
+        self.voice_id = voice_id
+        self.settings_key = tuple(sorted(voice_settings.items())) if voice_settings else None
+        self.low_latency = low_latency
+        # Worker threads have no Streamlit script context, so nothing they run may call st.*
+        self._executor = ThreadPoolExecutor(max_workers=ELEVENLABS_MAX_CONCURRENCY)
+        self._futures = [] # One per submitted chunk, in story order
+        self._sentences = [] # Sentences not yet batched into a chunk
+        self._held_chunk = None # Chunk waiting for its next_text before it is submitted
+        self._previous_chunk = ""
+        self._first_taken = False # Whether the opening line has been handed out
+        self._cancelled = threading.Event()
+
+    def _synthesize(self, chunk, previous_text, next_text):
+        chunk_digest = content_digest("\x00".join((previous_text, chunk, next_text)))
+        # Every story's workers share the same slots, so concurrent sessions together stay
+        # within ELEVENLABS_MAX_CONCURRENCY; a story cancelled while waiting sends nothing
+        with _elevenlabs_request_slots():
+            if self._cancelled.is_set():
+                raise CancelledError()
+            return _synthesize_chunk_cached(
+                chunk_digest, self.voice_id, self.settings_key, self.low_latency, chunk, previous_text, next_text
+            )
+
+    def _submit(self, chunk, next_text=""):
+        self._futures.append(self._executor.submit(self._synthesize, chunk, self._previous_chunk, next_text))
+        self._previous_chunk = chunk
+
+    def _add_chunk(self, chunk):
+        if not self._futures:
+            self._submit(chunk) # Don't delay the opening line waiting for its next_text
+        else:
+            if self._held_chunk is not None:
+                self._submit(self._held_chunk, next_text=chunk)
+            self._held_chunk = chunk
+
+    def add_sentence(self, sentence):
+        """Queues a sentence; it is submitted once its chunk is full."""
+        self._sentences.append(sentence)
+        batched = " ".join(self._sentences)
+        if not self._futures or len(batched) >= self.CHUNK_CHARS:
+            self._sentences = []
+            self._add_chunk(batched)
+
+    def finish(self):
+        """Submits whatever text is still buffered; call once the last sentence is added."""
+        if self._sentences:
+            self._add_chunk(" ".join(self._sentences))
+            self._sentences = []
+        if self._held_chunk is not None:
+            self._submit(self._held_chunk)
+            self._held_chunk = None
+
+    def take_first_segment(self, wait=True):
+        """Returns the first chunk's MP3 bytes once, or None if already taken or not ready."""
+        # With wait=False this never blocks, so it can be polled while the story streams in;
+        # a failed first chunk is left for segments() to raise
+        if self._first_taken or not self._futures:
+            return None
+        first = self._futures[0]
+        if not wait and (not first.done() or first.exception() is not None):
+            return None
+        segment = first.result()
+        self._first_taken = True
+        return segment
+
+    def segment_seconds(self, segment):
+        """Approximate playback length of an MP3 segment produced by this pipeline."""
+        return len(segment) * 8 / (self.LOW_LATENCY_BITRATE if self.low_latency else self.BITRATE)
+
+    def cancel(self):
+        """Drops every chunk not yet sent to ElevenLabs, e.g. when the story failed."""
+        self._sentences = []
+        self._held_chunk = None
+        self._cancelled.set()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def segments(self):
+        """Yields the MP3 bytes of every chunk in story order, the opening line included."""
+        self.finish()
+        try:
+            for future in self._futures:
+                yield future.result()
+        finally:
+            self._executor.shutdown(wait=False, cancel_futures=True)
 
 # Modified to accept voice_settings and use the client instance
-def convert_text_to_speech_elevenlabs(text, voice="Rachel", voice_settings=None):
+def convert_text_to_speech_elevenlabs(text, voice_id=DEFAULT_VOICE_ID, voice_settings=None, low_latency=False, on_first_segment=None, speech=None):
     """Converts text to speech using ElevenLabs API for more human-like voice."""
+    # speech, if given, is a SpeechPipeline that text's sentences were already added to;
+    # otherwise text is split and synthesized here. on_first_segment, if given, receives the
+    # opening line's MP3 bytes as soon as they are ready; the returned audio is always the
+    # whole story.
     # Ensure client is initialized and text is provided
     if not text or not elevenlabs_client:
         return None
+    if speech is None:
+        speech = SpeechPipeline(voice_id=voice_id, voice_settings=voice_settings, low_latency=low_latency)
+        for sentence in split_sentences(text) or [text]:
+            speech.add_sentence(sentence)
     try:
-        # --- Prepare parameters for client.generate ---
-        generate_params = {
-            "text": text,
-            "voice": voice, # Pass the voice name or voice_id
-            "model": "eleven_multilingual_v2", # Using a common model name
-            # Add other potential parameters here as needed by the API/client
-            # For example, you might add a pronunciation_dictionary_locators list
-        }
-
-        if voice_settings:
-             # Create a VoiceSettings object from the slider values
-             # Note: ElevenLabs API parameter is typically 'similarity_boost', not 'clarity'
-             settings_object = VoiceSettings(
-                 stability=voice_settings.get("stability", 0.5),
-                 similarity_boost=voice_settings.get("clarity", 0.75) # Map 'clarity' slider value to 'similarity_boost'
-             )
-             # Add the created VoiceSettings object under the 'voice_settings' key
-             generate_params["voice_settings"] = settings_object
-
-        # Call the generate method on the client instance using the prepared parameters
-        # The client's generate method expects the VoiceSettings object via the 'voice_settings' parameter
-        audio_stream = elevenlabs_client.generate(**generate_params)
-
-
-        # audio_stream is typically an iterator/generator, so read it into bytes
-        # Ensure audio_stream is iterable
-        if not hasattr(audio_stream, '__iter__'):
-             st.error("ElevenLabs generate did not return an iterable stream.")
-             return None
-
-        audio_bytes = b"".join(list(audio_stream))
-
-        # Save to a temporary file and return the data
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as temp_file:
-            temp_file.write(audio_bytes)
-            temp_path = temp_file.name
-
-        # Clean up
-        Path(temp_path).unlink(missing_ok=True)
-
-        return audio_bytes # Return the gathered bytes
+        speech.finish()
+
+        if on_first_segment:
+            first_segment = speech.take_first_segment()
+            if first_segment:
+                on_first_segment(first_segment)
+        # ElevenLabs MP3 segments can be concatenated back in order
+        return b"".join(speech.segments())
     except Exception as e:
-        st.error(f"An error occurred during ElevenLabs speech conversion: {e}")
+        if handle_elevenlabs_error(e, "An error occurred during ElevenLabs speech conversion"):
+            return convert_text_to_speech_gtts(text)
         return None
+    finally:
+        # If the opening line failed, later chunks are still queued and would be billed
+        speech.cancel()
+
+# Cached per text digest for a day
+@st.cache_data(max_entries=64, ttl=24 * 3600, show_spinner=False)
+def _synthesize_gtts_cached(text_digest, _text):
+    tts = gTTS(text=_text, lang='en', slow=False)
+    audio_fp = io.BytesIO() # Corrected typo BytesBytes to BytesIO
+    tts.write_to_fp(audio_fp)
+    audio_fp.seek(0)
+    return audio_fp.getvalue()
 
 def convert_text_to_speech_gtts(text):
     """Fallback to gTTS if ElevenLabs is not configured."""
     if not text:
         return None
     try:
-        tts = gTTS(text=text, lang='en', slow=False)
-        audio_fp = io.BytesIO() # Corrected typo BytesBytes to BytesIO
-        tts.write_to_fp(audio_fp)
-        audio_fp.seek(0)
-        return audio_fp.getvalue()
+        return _synthesize_gtts_cached(content_digest(text), text)
     except Exception as e:
         st.error(f"An error occurred during gTTS conversion: {e}")
         return None
 
+# Cached for an hour so widget reruns don't refetch the voice list; keyed on a prefix of
+# the API key's digest so changing the key invalidates the entry.
+@st.cache_data(ttl=3600, show_spinner=False)
+def _fetch_voices(api_key_digest):
+    """Returns the sorted ElevenLabs voice names and a name -> voice_id mapping."""
+    # Get available voices using the client instance
+    voices_result = elevenlabs_client.voices.get_all() # Fetch the data
+
+    # --- Extract the list of voice objects from the result ---
+    voices_list_objects = []
+    # Check if it's the expected GetVoicesResponse object with a 'voices' list attribute
+    if isinstance(voices_result, GetVoicesResponse) and hasattr(voices_result, 'voices') and isinstance(voices_result.voices, list):
+        voices_list_objects = voices_result.voices # Extract the list from the 'voices' attribute
+    elif isinstance(voices_result, tuple) and len(voices_result) > 1 and isinstance(voices_result[1], list):
+         # Keep the older ('voices', [...]) structure check for robustness
+         voices_list_objects = voices_result[1]
+         st.info("Handled older ElevenLabs voices response tuple structure.") # Add a note if this path is hit
+    elif isinstance(voices_result, list):
+         # Keep the direct list check for robustness
+         voices_list_objects = voices_result
+         st.info("Handled ElevenLabs voices response as a direct list.") # Add a note if this path is hit
+    else:
+         st.warning(f"Unexpected structure from elevenlabs_client.voices.get_all(): {type(voices_result)}. Cannot list voices.")
+         voices_list_objects = [] # Ensure it's an empty list if structure is unknown
+
+
+    # --- Extract voice names from the list; items without a .name are skipped ---
+    named_voices = [voice for voice in voices_list_objects if hasattr(voice, 'name')]
+    voice_names = [voice.name for voice in named_voices]
+    voice_ids = {voice.name: getattr(voice, 'voice_id', DEFAULT_VOICE_ID) for voice in named_voices} # Maps voice names to the voice_id the streaming endpoint expects
+
+    # Report malformed entries once rather than emitting one warning per item
+    skipped = len(voices_list_objects) - len(named_voices)
+    if skipped:
+        st.warning(f"Skipped {skipped} voice entries with unexpected structure (no .name).")
+
+    # Ensure unique names and sort
+    voice_names = sorted(dict.fromkeys(voice_names))
+
+    return voice_names, voice_ids
+
 # --- Streamlit App Interface ---
 st.title("🖼️✍️🎙️ AI Image-to-Story with Human-like Voice")
 st.markdown("Upload an image, provide a story prompt, and let AI create a narrative and read it aloud with a natural human voice!")
@@ -179,11 +488,13 @@ with col1:
 
     if uploaded_file is not None:
         try:
-            image = Image.open(uploaded_file)
-            image_display_slot.image(image, caption="Uploaded Image.", use_container_width=True)
-            # Re-open the file to get bytes for the API call later
-            uploaded_file.seek(0) # Reset file pointer to the beginning
-            uploaded_image_bytes = io.BytesIO(uploaded_file.getvalue())
+            # Copy the upload into bytes once per file rather than on every rerun
+            if st.session_state.get("img_file_id") != uploaded_file.file_id:
+                st.session_state["img_bytes"] = uploaded_file.getvalue()
+                st.session_state["img_file_id"] = uploaded_file.file_id
+            uploaded_image_bytes = st.session_state["img_bytes"]
+            # Display straight from the encoded bytes; no PIL decode is needed just to show it
+            image_display_slot.image(uploaded_image_bytes, caption="Uploaded Image.", use_container_width=True)
         except Exception as e:
             st.error(f"Error opening image: {e}")
             uploaded_file = None # Reset uploaded file on error
@@ -201,66 +512,29 @@ with col2:
     st.header("3. Voice Options")
 
     selected_voice = None # Initialize selected_voice
+    voice_ids = {} # Maps voice names to the voice_id the streaming endpoint expects
     voice_settings = None # Initialize voice_settings
+    low_latency_mode = False # ElevenLabs turbo model toggle
+
+    voice_names = []
+    voice_fetch_failed = False
+    if elevenlabs_client is not None:
+        try:
+            voice_names, voice_ids = _fetch_voices(content_digest(elevenlabs_api_key)[:16])
+        except Exception as e:
+            # Catch any error during the get_all() call or subsequent processing
+            voice_fetch_failed = True
+            if handle_elevenlabs_error(e, "Could not fetch or process ElevenLabs voices using client"):
+                elevenlabs_client = None # Refused: use gTTS for this run too, not just the next one
 
     # If ElevenLabs client is configured, show voice options
     if elevenlabs_client is not None: # Use the client instance existence check
         st.text("Using ElevenLabs for human-like voice.")
-        try:
-            # Get available voices using the client instance
-            voices_result = elevenlabs_client.voices.get_all() # Fetch the data
-
-            # --- Extract the list of voice objects from the result ---
-            voices_list_objects = []
-            # Check if it's the expected GetVoicesResponse object with a 'voices' list attribute
-            if isinstance(voices_result, GetVoicesResponse) and hasattr(voices_result, 'voices') and isinstance(voices_result.voices, list):
-                voices_list_objects = voices_result.voices # Extract the list from the 'voices' attribute
-            elif isinstance(voices_result, tuple) and len(voices_result) > 1 and isinstance(voices_result[1], list):
-                 # Keep the older ('voices', [...]) structure check for robustness
-                 voices_list_objects = voices_result[1]
-                 st.info("Handled older ElevenLabs voices response tuple structure.") # Add a note if this path is hit
-            elif isinstance(voices_result, list):
-                 # Keep the direct list check for robustness
-                 voices_list_objects = voices_result
-                 st.info("Handled ElevenLabs voices response as a direct list.") # Add a note if this path is hit
-            else:
-                 st.warning(f"Unexpected structure from elevenlabs_client.voices.get_all(): {type(voices_result)}. Cannot list voices.")
-                 voices_list_objects = [] # Ensure it's an empty list if structure is unknown
-
-
-            voice_names = []
-            if voices_list_objects: # Check if the extracted list is not empty
-                # --- Robustly extract voice names from the list ---
-                for voice in voices_list_objects:
-                    try:
-                        # Check if the item in the list has a .name attribute (like Voice objects do)
-                        if hasattr(voice, 'name'):
-                            voice_names.append(voice.name)
-                        # Add checks for other structures if necessary (e.g., dict)
-                        # elif isinstance(voice, dict) and 'name' in voice:
-                        #     voice_names.append(voice['name'])
-                        else:
-                             # Fallback if the object doesn't have a .name attribute
-                             st.warning(f"Item in voice list has unexpected structure (no .name): {voice}. Skipping.")
-                             # Decide whether to append str(voice) or just skip
-                             pass # Skipping unexpected items
-                    except Exception as e:
-                        st.warning(f"Error processing item in voice list {voice}: {e}. Skipping.")
-                        pass # Skipping problematic items
-
-
-            # Ensure unique names and sort
-            voice_names = list(set(voice_names))
-            voice_names.sort()
-
-            if voice_names:
-                selected_voice = st.selectbox("Choose a voice:", voice_names, index=0)
-            else:
+        if voice_names:
+            selected_voice = st.selectbox("Choose a voice:", voice_names, index=0)
+        else:
+            if not voice_fetch_failed: # A failed fetch has already been reported
                 st.warning("No usable ElevenLabs voices found via API or extraction failed. Using default 'Rachel' (may fail if not available).")
-                selected_voice = "Rachel"  # Default voice (ensure this voice exists or handle error)
-        except Exception as e:
-            # Catch any error during the get_all() call or subsequent processing
-            st.error(f"Could not fetch or process ElevenLabs voices using client: {e}")
             selected_voice = "Rachel"  # Default voice (ensure this voice exists or handle error)
 
         st.markdown("Voice emotion settings (ElevenLabs):")
@@ -270,6 +544,7 @@ with col2:
         clarity = st.slider("Clarity / Similarity Boost", 0.0, 1.0, 0.75, 0.01, key="eleven_clarity")
         # Store voice settings to be used later
         voice_settings = {"stability": stability, "clarity": clarity} # Store with keys matching how you'll use them
+        low_latency_mode = st.checkbox("Low-latency mode", help="Use the faster eleven_turbo_v2_5 model at a lower audio bitrate.", key="eleven_low_latency")
 
     else:
         st.text("Using Google TTS (Standard voice) as ElevenLabs client is not configured.")
@@ -284,39 +559,93 @@ with col2:
 
     if st.button("✨ Create Story and Speech", disabled=button_disabled):
         if uploaded_file and story_prompt:
-            # Ensure uploaded_image_bytes is created again as st.file_uploader re-runs on interaction
-            # The file pointer needs to be reset if the file was successfully uploaded initially
-            try:
-                uploaded_file.seek(0)
-                uploaded_image_bytes = io.BytesIO(uploaded_file.getvalue())
-            except Exception as e:
-                 st.error(f"Could not re-read uploaded file: {e}")
-                 uploaded_image_bytes = None # Ensure it's None if re-reading fails
-
             if uploaded_image_bytes: # Proceed only if image bytes are available
-                with st.spinner("Letting the AI craft a story... ✍️"):
-                    # Pass the BytesIO object or bytes to the generator
-                    generated_story = generate_story_from_image(uploaded_image_bytes, story_prompt)
-
-                if generated_story and not generated_story.startswith("An error occurred") and not generated_story.startswith("Story generation unavailable") and not generated_story.startswith("Could not generate"):
-                    st.subheader("📜 Generated Story:")
-                    st.write(generated_story)
-
-                    with st.spinner("Converting story to speech... 🎙️"):
-                        # Use the client instance existence check
-                        if elevenlabs_client and selected_voice: # Check if client exists and a voice was selected
-                            # Pass voice settings if ElevenLabs is used
-                            audio_bytes = convert_text_to_speech_elevenlabs(generated_story, voice=selected_voice, voice_settings=voice_settings)
+                use_elevenlabs = elevenlabs_client and selected_voice # Check if client exists and a voice was selected
+                speech = None
+                if use_elevenlabs:
+                    # Start the TTS pipeline first so sentences are narrated while Gemini is still writing
+                    selected_voice_id = voice_ids.get(selected_voice, DEFAULT_VOICE_ID)
+                    speech = SpeechPipeline(voice_id=selected_voice_id, voice_settings=voice_settings, low_latency=low_latency_mode)
+
+                try:
+                    story_slot = st.empty() # Shows the story as it streams in
+                    opening_line_slot = st.empty() # Plays the first sentence while the rest is narrated
+
+                    opening_line = {} # When the opening line started playing and how long it lasts
+
+                    def play_opening_line(segment):
+                        opening_line["started"] = time.monotonic()
+                        opening_line["seconds"] = speech.segment_seconds(segment)
+                        with opening_line_slot.container():
+                            st.subheader("🗣️ Listen to the Story:")
+                            st.caption("Opening line:")
+                            st.audio(segment, format="audio/mp3", autoplay=True)
+
+                    def show_story(text):
+                        with story_slot.container():
+                            st.subheader("📜 Generated Story:")
+                            st.write(text)
+                        # Start playback as soon as the opening line is synthesized, even mid-stream
+                        if speech:
+                            segment = speech.take_first_segment(wait=False)
+                            if segment:
+                                play_opening_line(segment)
+
+                    with st.spinner("Letting the AI craft a story... ✍️"):
+                        # Pass the canonical image bytes read in the upload section
+                        story_result = generate_story_from_image(
+                            uploaded_image_bytes,
+                            story_prompt,
+                            on_text=show_story,
+                            on_sentence=speech.add_sentence if speech else None,
+                        )
+
+                    if story_result.ok:
+                        generated_story = story_result.text
+
+                        with st.spinner("Converting story to speech... 🎙️"):
+                            if use_elevenlabs:
+                                # The story's sentences were already submitted to the pipeline as they streamed in;
+                                # the opening line is played here if it wasn't ready during streaming
+                                audio_bytes = convert_text_to_speech_elevenlabs(
+                                    generated_story,
+                                    on_first_segment=play_opening_line,
+                                    speech=speech,
+                                )
+                            else:
+                                # Use gTTS if ElevenLabs is not configured or voice selection failed
+                                audio_bytes = convert_text_to_speech_gtts(generated_story)
+
+                        if use_elevenlabs and st.session_state.get("elevenlabs_key_rejected"):
+                            # ElevenLabs refused (401) after the opening line may have played, so audio_bytes
+                            # is the whole story in the gTTS voice; start it from the top instead of resuming
+                            opening_line.clear()
+
+                        if audio_bytes:
+                            # Replace the opening line's player with the full narration, resumed from
+                            # about where the opening line has got to so playback carries on
+                            resume_at = 0
+                            if opening_line:
+                                elapsed = time.monotonic() - opening_line["started"]
+                                resume_at = int(min(elapsed, opening_line["seconds"]))
+                            with opening_line_slot.container():
+                                st.subheader("🗣️ Listen to the Story:")
+                                st.audio(audio_bytes, format="audio/mp3", start_time=resume_at, autoplay=bool(opening_line))
+                        elif opening_line:
+                            st.warning("Could not generate audio for the rest of the story.")
                         else:
-                            # Use gTTS if ElevenLabs is not configured or voice selection failed
-                            audio_bytes = convert_text_to_speech_gtts(generated_story)
-
-                if audio_bytes:
-                    st.subheader("🗣️ Listen to the Story:")
-                    st.audio(audio_bytes, format="audio/mp3")
-                else:
-                    st.warning("Could not generate audio for the story.")
-            else: # Handle case where uploaded_image_bytes is None after trying to re-read
+                            st.warning("Could not generate audio for the story.")
+                    else:
+                        # Drop any partially streamed text and opening line of a story that will never be shown
+                        story_slot.empty()
+                        st.error(story_result.err)
+                        opening_line_slot.empty()
+                finally:
+                    # Drop queued chunks however this run ends, including a failed story, an exception
+                    # or a Streamlit rerun/stop (a BaseException); it is a no-op once narration finished
+                    if speech:
+                        speech.cancel()
+            else: # Handle case where the upload could not be read
                 st.warning("Could not process the uploaded image.")
 
         elif not uploaded_file:
@@ -3,10 +3,20 @@ import streamlit as st
 from PIL import Image # Import Image to open the local image file
 import os # Import os to help with path
 from pathlib import Path # Import Path for better path handling
+import io # Import io to encode the thumbnail in memory
 st.set_page_config(page_title="About Me", layout="centered") # Optional: set page config for this page
 
 st.title("About Muhammad Ishaque Nizamani")
 
+# Decode and shrink the photo once per process instead of re-reading it on every page view
+@st.cache_data(show_spinner=False)
+def _thumb(path, w):
+    img = Image.open(path)
+    img.thumbnail((w, w * 2))
+    buf = io.BytesIO()
+    img.convert("RGB").save(buf, format="JPEG", quality=85)
+    return buf.getvalue()
+
 # --- Load and display the image ---
 # Assuming the image is in the same 'pages' directory
 # Adjust the path if your image is elsewhere
@@ -15,7 +25,7 @@ image_path = os.path.join(current_dir, "ishaque.jpg")
 
 # image_path = "ishaque.jpg" # <-- Make sure this matches your image filename
 try:
-    st.image(image_path, caption="Muhammad Ishaque Nizamani", width=400)
+    st.image(_thumb(str(image_path), 400), caption="Muhammad Ishaque Nizamani", width=400)
 except FileNotFoundError:
     st.error(f"Image not found at {image_path}. Please check the image location.")
 except Exception as e: